@@ -3,60 +3,405 @@
 # Write minimal DNG
 #
 
-import sys, getopt, os.path
+import sys, getopt, os, os.path, stat, time, json, socket, base64
 from array import array
-from lraw import ltiff, ldng
+from cStringIO import StringIO
+from lraw import ltiff, ldng, lmanifest, lfuzz, ledit, lcrop
 
 
-def gen_RGB_checkerboard(w, h, nrow=3, ncol=5, mn=1, mx=255):
-    """simple gray-scale block image for testing
+def checker_pattern(w, h, nrow=3, ncol=5, mn=1, mx=255):
+    """simple gray-scale block pattern for testing, the pattern can be
+    evaluated per row and channel, see ldng.DNG_Image.mosaic
 
-    usage: gen_RGB_checker(w, h, nrow=3, ncol=5, mn=1, mx=255)
+    usage: pattern = checker_pattern(w, h, nrow=3, ncol=5, mn=1, mx=255)
+           vals = pattern(jj, chn) - w samples of row jj, channel chn
     """
 
-    npix = 3*w*h
-    data = array('H')
-
     scl = float(mx - mn)/float(w+h)
 
     h_row = h/nrow
     w_col = w/ncol
-    for jj in range(h):
+    cols = [kk/w_col for kk in range(w)]
+
+    # gray-scale, all channels are the same
+    last = [None, None]
+
+    def pattern(jj, chn):
+        if last[0] == jj:
+            return last[1]
+
         row = jj/h_row
+        vals = []
         for kk in range(w):
-            col = kk/w_col
-
             x = int(scl * (jj + kk))
-            p = (row ^ col) & 1
-            #c = x + mn
-            c = x + mn if p == 0 else mx - x
+            p = (row ^ cols[kk]) & 1
+            vals.append(x + mn if p == 0 else mx - x)
+
+        last[0], last[1] = jj, vals
+        return vals
+
+    return pattern
+
+
+def moving_checker(w, h, t, nrow=3, ncol=4, mn=990, mx=30000, dx=4, dy=2):
+    """checker board of two levels, moving (dx, dy) pixels per frame
+
+    usage: pattern, row_key = moving_checker(w, h, t, ...)
+    t - frame no.
+    """
+
+    h_row = h/nrow
+    w_col = w/ncol
+    x0 = dx*t
+    y0 = dy*t
+
+    cols = [((kk + x0)/w_col) & 1 for kk in range(w)]
+    vals = ([mn if c == 0 else mx for c in cols],
+            [mx if c == 0 else mn for c in cols])
+
+    # only the horizontal phase and the band parity change a row
+    def row_key(jj):
+        return (x0 % (2*w_col), ((jj + y0)/h_row) & 1)
+
+    def pattern(jj, chn):
+        return vals[((jj + y0)/h_row) & 1]
+
+    return pattern, row_key
+
+
+def panning_ramp(w, h, t, mn=990, mx=30000, dx=8):
+    """horizontal ramp mn..mx, wrapping around, panning dx pixels per frame
+
+    usage: pattern, row_key = panning_ramp(w, h, t, ...)
+    """
+
+    x0 = dx*t
+    vals = [mn + ((kk + x0) % w)*(mx - mn)/(w - 1) for kk in range(w)]
+
+    def row_key(jj):
+        return x0 % w
+
+    def pattern(jj, chn):
+        return vals
 
-            data.append(c)
-            data.append(c)
-            data.append(c)
+    return pattern, row_key
+
+
+animations = {'movchecker' : moving_checker, 'panramp' : panning_ramp}
+
+
+def gen_sequence(w, h, anim, nframes, fps, dst, comp=None):
+    """write numbered DNG frames, dst_000000.dng, ... and report the
+    sustained frame rate against fps
+    """
+
+    seq = ldng.DNG_Sequence(w, h, fps)
+    seq.img.set_model('gen_dng', 'test-seq')
+
+    _fname, _ext = os.path.splitext(dst)
+    verbose = ltiff._verbose
+    ltiff._verbose = False
+
+    t0 = time.time()
+    nrows = 0
+    try:
+        for t in range(nframes):
+            pattern, row_key = anim(w, h, t)
+            img = seq.set_frame(t, pattern, row_key)
+            nrows += seq.nrows
+            compress(img, comp)
+
+            tif = ltiff.TIFF()
+            tif.add_image(img)
+            tif.write("{0}_{1:06d}{2}".format(_fname, t, _ext))
+    finally:
+        ltiff._verbose = verbose
+
+    secs = max(time.time() - t0, 1e-6)
+    rate = nframes/secs
+    if verbose:
+        print ".. sequence: {0} frames {1}x{2} in {3:.2f} s, {4:.1f} fps, target {5} fps - {6}".format(
+            nframes, w, h, secs, rate, fps,
+            "real-time" if rate >= fps else "{0:.2f}x slower".format(fps/rate))
+        print ".. rows updated/frame: {0:.1f} of {1}".format(
+            float(nrows)/max(nframes, 1), h)
+    return rate
+
+
+def gen_RGB(w, h, pattern):
+    "evaluate pattern for all pixels, returns array with RGB samples"
+
+    data = array('H')
+    row = array('H', [0])*(3*w)
+    for jj in range(h):
+        for chn in range(3):
+            row[chn::3] = array('H', pattern(jj, chn))
+        data.extend(row)
 
     return data
 
 
-def gen_test_tiff(w, h, data, fname):
+def gen_RGB_checkerboard(w, h, nrow=3, ncol=5, mn=1, mx=255):
+    """simple gray-scale block image for testing
+
+    usage: gen_RGB_checker(w, h, nrow=3, ncol=5, mn=1, mx=255)
+    """
+
+    return gen_RGB(w, h, checker_pattern(w, h, nrow, ncol, mn, mx))
+
+
+def compress(img, comp):
+    """deflate compress image, comp = (level, predictor, nthreads) or None,
+    returns compression statistics or None
+    """
+
+    if comp is None:
+        return None
+
+    level, pred, nthreads = comp
+    st = img.compress(level=level, predictor=pred, nthreads=nthreads)
+
+    if ltiff._verbose:
+        mbps = st['raw']/(1e6*max(st['secs'], 1e-6))
+        print ".. deflate: {0} -> {1} bytes, ratio {2:.2f}, {3} strips, {4:.1f} MB/s".format(
+            st['raw'], st['comp'], float(st['raw'])/st['comp'],
+            st['nstrips'], mbps)
+    return st
+
+
+def gen_test_tiff(w, h, data, fname, comp=None, manifest=False):
     "write test TIFF image from RGB data"
 
     img = ltiff.RGB_Image()
     img.set_data(w, h, data)
     img.set_model('gen_dng', 'test-tiff')
+    compress(img, comp)
 
     _fname, _ext = os.path.splitext(fname)
     tif = ltiff.TIFF()
     tif.add_image(img)
-    tif.write(_fname + '.tif')
+    tif.write(_fname + '.tif', manifest=manifest)
+
+# ---------------------------------------------------------------------
+# service mode, i.e. one process generating many files on request
+
+class Generator(object):
+    """long running DNG generator, keeps the mosaiced test patterns
+    and a template image per (w, h, mn, mx) in a cache, so repeated
+    requests only pay for the I/O
+
+    request (one JSON object per line):
+      {"id": .., "test": "checker", "width": w, "height": h,
+       "nrow": 3, "ncol": 4, "mn": 990, "mx": 30000,
+       "out": <dng path>, "tiff": false, "deflate": <level>,
+       "predictor": false, "manifest": false}
+    without "out" the DNG is returned base64 encoded in "data"
+    """
+
+    max_cache = 16
+
+    def __init__(self):
+        self.cache = {}
+        self.order = []
+        self.images = {}
+        self.img_order = []
+
+
+    def pattern(self, req):
+        "return (w, h, pattern, txt, mn, mx) for request, cached"
+
+        test = req.get('test', 'checker')
+        w = int(req.get('width', 4*146))
+        h = int(req.get('height', 3*146))
+        nrow = int(req.get('nrow', 3))
+        ncol = int(req.get('ncol', 4))
+        mn = int(req.get('mn', 990))
+        mx = int(req.get('mx', 30000))
+
+        key = (test, w, h, nrow, ncol, mn, mx)
+        if key in self.cache:
+            return self.cache[key]
+
+        if test != "checker":
+            raise ValueError("unknown test pattern '{0}'".format(test))
+
+        pattern = checker_pattern(w, h, nrow=nrow, ncol=ncol, mn=mn, mx=mx)
+        txt, smn, smx = ldng.DNG_Image.mosaic(w, h, pattern)
+
+        entry = (w, h, pattern, txt, smn, smx)
+        self.cache[key] = entry
+        self.order.append(key)
+        if len(self.order) > self.max_cache:
+            del self.cache[self.order.pop(0)]
+        return entry
+
+
+    def template(self, w, h, txt, mn, mx):
+        """DNG_Image with the tags for (w, h, mn, mx) and data txt, the
+        image is cached and re-used, with data, strips and dates reset
+        """
+
+        key = (w, h, mn, mx)
+        img = self.images.get(key)
+        if img is None:
+            img = ldng.DNG_Image()
+            img.set_raw(w, h, txt, mn, mx)
+            img.set_model('gen_dng', 'test-conv')
+
+            self.images[key] = img
+            self.img_order.append(key)
+            if len(self.img_order) > self.max_cache:
+                del self.images[self.img_order.pop(0)]
+            return img
+
+        if img.data is not txt:
+            img.data = txt
+            img.set_digest()
+        img.reset_strips()
+
+        tm = time.localtime()
+        stamp = time.strftime("%Y:%m:d %H:%M:S", tm)
+        for tag in (0x0132, 0x9003, 0x9004):
+            img.add_tag(tag, stamp)
+        return img
+
+
+    def handle(self, req):
+        "process single request, return reply dictionary"
+
+        t0 = time.time()
+        w, h, pattern, txt, mn, mx = self.pattern(req)
+        img = self.template(w, h, txt, mn, mx)
+
+        comp = None
+        if req.get('deflate') is not None:
+            comp = (int(req['deflate']), bool(req.get('predictor', False)), None)
+
+        tif = ltiff.TIFF()
+        tif.add_image(img)
+
+        rep = {'status' : 'ok'}
+        st = compress(img, comp)
+        if st is not None:
+            rep['ratio'] = float(st['raw'])/st['comp']
+        out = req.get('out')
+        if out is None:
+            fn = StringIO()
+            tif.write_fn(fn)
+            buf = fn.getvalue()
+            rep['nbytes'] = len(buf)
+            rep['data'] = base64.b64encode(buf)
+        else:
+            man = bool(req.get('manifest', False))
+            if req.get('tiff', False):
+                gen_test_tiff(w, h, gen_RGB(w, h, pattern), out, comp, man)
+            tif.write(out, manifest=man)
+            rep['out'] = out
+            rep['nbytes'] = os.path.getsize(out)
+
+        rep['latency_ms'] = 1e3*(time.time() - t0)
+        return rep
+
+
+    def serve_fn(self, fin, fout):
+        "process JSONL requests from fin until EOF, reply to fout"
+
+        for line in iter(fin.readline, ''):
+            line = line.strip()
+            if not line:
+                continue
+
+            req = {}
+            try:
+                req = json.loads(line)
+                rep = self.handle(req)
+            except (Exception, ltiff.TiffException) as e:
+                # report and carry on with next request
+                rep = {'status' : 'error', 'msg' : str(e)}
+
+            if isinstance(req, dict) and 'id' in req:
+                rep['id'] = req['id']
+            fout.write(json.dumps(rep) + '\n')
+            fout.flush()
+
+
+    def serve_socket(self, path):
+        """accept connections on unix socket, one at a time, a stale
+        socket at path is removed, any other file is left alone
+        """
+
+        if os.path.exists(path):
+            if not stat.S_ISSOCK(os.stat(path).st_mode):
+                raise socket.error("{0} exists and is not a socket".format(
+                    path))
+            os.unlink(path)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.listen(1)
+        try:
+            while True:
+                conn, _ = sock.accept()
+                fin = conn.makefile('rb')
+                fout = conn.makefile('wb')
+                try:
+                    self.serve_fn(fin, fout)
+                except socket.error:
+                    pass
+                finally:
+                    fin.close()
+                    fout.close()
+                    conn.close()
+        finally:
+            sock.close()
+            os.unlink(path)
+
+
+def serve(path):
+    """run generator service, on stdin/stdout if path is empty, else on
+    unix socket at path
+    """
+
+    # stdout carries the replies, keep it clean
+    ltiff._verbose = False
+
+    gen = Generator()
+    if path:
+        gen.serve_socket(path)
+    else:
+        gen.serve_fn(sys.stdin, sys.stdout)
+
 
 # ---------------------------------------------------------------------
 def usage(msg):
     txt = ( \
-        "usage: gen_dng [--test=<name>] [--tiff] <src-tif> <dst-dng>",
-        "--test : generate test image internally",
-        "         <name> : checker",
-        "--tiff : output data as tiff file, as well as DNG"
+        "usage: gen_dng [--test=<name>] [--tiff] [--deflate=<lvl>] <src-tif> <dst-dng>",
+        "       gen_dng --serve [--socket=<path>]",
+        "       gen_dng --compare <file-a> <file-b>",
+        "       gen_dng --fuzz=<n> [--seed=<s>] [--test=<name>] <src> <dst-dir>",
+        "       gen_dng --seq=<n> [--fps=<rate>] --test=<anim> <src> <dst-dng>",
+        "       gen_dng --set=<tag>:<values> [--set=..] <file> [<file> ..]",
+        "       gen_dng --crop=<x>,<y>,<w>,<h> <src-dng> <dst-dng>",
+        "--test  : generate test image internally",
+        "          <name> : checker",
+        "--size  : test image size <w>x<h>, default 584x438",
+        "--procs : no. of processes generating the DNG data in shared memory",
+        "--tiff  : output data as tiff file, as well as DNG",
+        "--deflate : deflate compress strips, zlib level 1..9",
+        "--predictor : apply horizontal differencing before deflate",
+        "--threads : no. of compression threads, default no. of cores",
+        "--manifest : write sidecar manifest with strip and IDF hashes",
+        "--compare : compare files via their manifests",
+        "--fuzz  : write n variants of src (or test image) with mutated IDFs",
+        "--seed  : random seed for --fuzz, default 0",
+        "--seq   : write n numbered frames dst_000000.dng, ...",
+        "          <anim> : movchecker, panramp",
+        "--fps   : frame rate of sequence, default 24",
+        "--set   : edit tag of existing files in place, e.g. 0xC61A:1024",
+        "          or 0xC628:1/2,1/1,1/2 for rationals",
+        "--crop  : extract ROI of src, aligned to the CFA repeat",
+        "--serve : read JSONL requests from stdin, reply on stdout",
+        "--socket: serve requests on unix socket <path> instead",
         "")
 
     print ">> gen_dng.py:", msg
@@ -65,58 +410,184 @@ def usage(msg):
     sys.exit(1)
 
 
+def parse_tag(txt):
+    """parse <tag>:<values> of --set, returns (tag, a, b) with b None
+    unless values are given as rationals n/d
+    """
+
+    try:
+        tag, vals = txt.split(':', 1)
+        tag = int(tag, 0)
+        vals = vals.split(',')
+        if '/' in vals[0]:
+            a = [int(v.split('/')[0]) for v in vals]
+            b = [int(v.split('/')[1]) for v in vals]
+            return tag, a, b
+        return tag, [int(v, 0) for v in vals], None
+    except (ValueError, IndexError):
+        usage("bad tag value '{0}'".format(txt))
+
+
 def cli_bits():
+    """parse command line
+
+    returns: src, dst, opt - with opt a dictionary of the options
+    """
     opt_txt = 'v'
-    long_opt = ('test=', 'tiff')
+    long_opt = ('test=', 'tiff', 'serve', 'socket=', 'deflate=',
+        'predictor', 'threads=', 'manifest', 'compare', 'size=', 'procs=',
+        'fuzz=', 'seed=', 'seq=', 'fps=', 'set=',
+        'crop=')
     options, args = getopt.getopt(sys.argv[1:], opt_txt, long_opt)
 
-    verbose = False
-    test = None
-    tiff = False
+    opt = {'verbose' : False, 'test' : None, 'tiff' : False,
+        'serve' : None, 'comp' : None, 'manifest' : False, 'compare' : False,
+        'size' : (4*146, 3*146), 'procs' : 1, 'fuzz' : None, 'seed' : 0,
+        'seq' : None, 'fps' : 24, 'set' : [], 'crop' : None}
+    level, pred, nthreads = None, False, None
     for o,a in options:
         if o == '-v':
-            verbose = True
+            opt['verbose'] = True
         if o == '--test':
-            test = a
+            opt['test'] = a
         if o == '--tiff':
-            tiff = True
+            opt['tiff'] = True
+        if o == '--serve' and opt['serve'] is None:
+            opt['serve'] = ''
+        if o == '--socket':
+            opt['serve'] = a
+        if o == '--deflate':
+            level = int(a)
+        if o == '--predictor':
+            pred = True
+        if o == '--threads':
+            nthreads = int(a)
+        if o == '--manifest':
+            opt['manifest'] = True
+        if o == '--compare':
+            opt['compare'] = True
+        if o == '--size':
+            opt['size'] = tuple(int(v) for v in a.lower().split('x'))
+        if o == '--procs':
+            opt['procs'] = int(a)
+        if o == '--fuzz':
+            opt['fuzz'] = int(a)
+        if o == '--seed':
+            opt['seed'] = int(a)
+        if o == '--seq':
+            opt['seq'] = int(a)
+        if o == '--fps':
+            opt['fps'] = float(a)
+        if o == '--set':
+            opt['set'].append(parse_tag(a))
+        if o == '--crop':
+            try:
+                opt['crop'] = tuple(int(v) for v in a.split(','))
+            except ValueError:
+                usage("bad crop '{0}'".format(a))
+            if len(opt['crop']) != 4:
+                usage("expect crop <x>,<y>,<w>,<h>")
+
+    if level is not None:
+        opt['comp'] = (level, pred, nthreads)
+
+    if opt['serve'] is not None:
+        if len(args) != 0:
+            usage("no args expected in service mode")
+        return None, None, opt
+
+    if opt['set']:
+        if len(args) == 0:
+            usage("expect file(s) to edit")
+        return args, None, opt
 
     if len(args) != 2:
         usage("unexpected no. of args")
     src = args[0]
     dst = args[1]
 
-    return src, dst, verbose, test, tiff
+    return src, dst, opt
 
 
 if __name__ == "__main__":
 
-    src_fname, dst_fname, verbose, test, otiff = cli_bits()
+    src_fname, dst_fname, opt = cli_bits()
+    test = opt['test']
+
+    if opt['serve'] is not None:
+        serve(opt['serve'])
+        sys.exit(0)
+
+    if opt['set']:
+        for fname in src_fname:
+            with ledit.TIFF_Editor(fname) as ed:
+                for tag, a, b in opt['set']:
+                    if b is None:
+                        ed.set_tag(tag, a)
+                    else:
+                        ed.set_rat_tag(tag, a, b)
+        sys.exit(0)
+
+    if opt['crop'] is not None:
+        x, y, w, h = opt['crop']
+        lcrop.crop(src_fname, x, y, w, h, dst_fname)
+        sys.exit(0)
+
+    if opt['compare']:
+        diffs = lmanifest.compare(src_fname, dst_fname)
+        for l in diffs:
+            print ">>", l
+        sys.exit(1 if diffs else 0)
 
 
     # prepare test image internally, for reference
+    if test is None and opt['fuzz'] is not None:
+        # mutate existing file
+        with open(src_fname, 'rb') as fn:
+            mut = lfuzz.Mutator(fn.read())
+        mut.write(dst_fname, opt['fuzz'], opt['seed'])
+        sys.exit(0)
+
+    if opt['seq'] is not None:
+        if test not in animations:
+            usage("expect --test=<anim> for sequence")
+        w, h = opt['size']
+        gen_sequence(w, h, animations[test], opt['seq'], opt['fps'],
+            dst_fname, opt['comp'])
+        sys.exit(0)
+
     if test is None:
         # load source RGB data from tiff file
         print ">> not implemented"
         sys.exit(1)
     else:
         # internal test image
-        w = 4*146
-        h = 3*146
+        w, h = opt['size']
         if test == "checker":
-            data = gen_RGB_checkerboard(w, h, nrow=3, ncol=4, 
+            pattern = checker_pattern(w, h, nrow=3, ncol=4,
                 mn=990, mx=30000)
+        else:
+            usage("unknown test image '{0}'".format(test))
 
-    if otiff:
-        gen_test_tiff(w, h, data, dst_fname)
+    if opt['tiff']:
+        data = gen_RGB(w, h, pattern)
+        gen_test_tiff(w, h, data, dst_fname, opt['comp'], opt['manifest'])
+        data = None
 
-    # build DNG image
+    # build DNG image, directly from CFA sites
     img = ldng.DNG_Image()
-    img.set_data(w, h, data)
+    img.set_pattern(w, h, pattern, nproc=opt['procs'])
     img.set_model('gen_dng', 'test-conv')
+    compress(img, opt['comp'])
 
     # and tiff container
     tif = ltiff.TIFF()
     tif.add_image(img)
-    tif.write(dst_fname)
-
+    if opt['fuzz'] is not None:
+        # encode once, then only mutate the IDFs
+        fn = StringIO()
+        tif.write_fn(fn)
+        mut = lfuzz.Mutator(fn.getvalue())
+        mut.write(dst_fname, opt['fuzz'], opt['seed'])
+    else:
+        tif.write(dst_fname, manifest=opt['manifest'])
@@ -0,0 +1,183 @@
+# -*- coding: utf8 -*-
+#
+# Region-of-interest crop of existing DNG files, only the strips/tiles
+# covering the ROI are read, for uncompressed data only the ROI rows
+
+import sys, zlib
+from array import array
+from lraw import ltiff, ldng, ljpeg
+
+# tags copied from the source raw IDF, and from IDF0 if not in raw IDF
+raw_tags = (0x828D, 0x828E, 0xC617, 0xC619, 0xC61A, 0xC61D, 0xC61E, 0xC62D)
+cam_tags = (0xC621, 0xC623, 0xC627, 0xC628, 0xC65A, 0xC62A)
+
+
+def find_raw(rd):
+    "IDF_dir with the CFA data, i.e. photometric CFA, main image first"
+
+    cfa = [d for d in rd.all_dirs() if d.value(0x0106) == 0x8023]
+    if not cfa:
+        raise ltiff.TiffException("no CFA image found")
+    main = [d for d in cfa if d.value(0x00FE, 0) == 0]
+    return main[0] if main else cfa[0]
+
+
+def _decode(txt, comp, pred, bo, tw):
+    "decode strip/tile to array('H') of native samples"
+
+    if comp == 7:
+        data, w, h = ljpeg.decode(txt)
+        return data
+
+    if comp == 8:
+        txt = zlib.decompress(txt)
+    elif comp != 1:
+        raise ltiff.TiffException("compression {0} not supported".format(comp))
+
+    data = array('H', txt)
+    if (bo == '>') != (sys.byteorder == 'big'):
+        data.byteswap()
+
+    if comp == 8 and pred == 2:
+        for ofs in range(0, len(data), tw):
+            acc = 0
+            for jj in range(ofs, min(ofs + tw, len(data))):
+                acc = (acc + data[jj]) & 0xFFFF
+                data[jj] = acc
+    return data
+
+
+def read_roi(fn, rd, d, x, y, w, h):
+    """read w x h samples at (x, y) of 16-bit CFA image d
+
+    usage: data = read_roi(fn, rd, d, x, y, w, h)
+    data - array('H') with native samples
+    """
+
+    if d.value(0x0102) != 16 or d.value(0x0115, 1) != 1:
+        raise ltiff.TiffException("expect 16-bit, single sample CFA data")
+
+    comp = d.value(0x0103, 1)
+    pred = d.value(0x013D, 1)
+    width = d.value(0x0100)
+    height = d.value(0x0101)
+    swap = (rd.bo == '>') != (sys.byteorder == 'big')
+
+    out = array('H', [0])*(w*h)
+    for tx, ty, tw, th, ofs, n in d.tiles():
+        x0, x1 = max(x, tx), min(x + w, tx + tw, width)
+        y0, y1 = max(y, ty), min(y + h, ty + th, height)
+        if x0 >= x1 or y0 >= y1:
+            continue
+
+        if comp == 1:
+            # read the ROI part of each row only
+            for jj in range(y0, y1):
+                row = array('H', rd.read(ofs + 2*((jj - ty)*tw + x0 - tx),
+                    2*(x1 - x0)))
+                if swap:
+                    row.byteswap()
+                dst = (jj - y)*w + x0 - x
+                out[dst:dst + x1 - x0] = row
+            continue
+
+        data = _decode(rd.read(ofs, n), comp, pred, rd.bo, tw)
+        for jj in range(y0, y1):
+            src = (jj - ty)*tw + x0 - tx
+            dst = (jj - y)*w + x0 - x
+            out[dst:dst + x1 - x0] = data[src:src + x1 - x0]
+
+    return out
+
+
+def _ints(e):
+    "values of entry as int, rationals divided"
+    v = e.values()
+    if e.tpe in (5, 10):
+        return [v[jj]/v[jj+1] if v[jj+1] else 0 for jj in range(0, len(v), 2)]
+    return list(v)
+
+
+def crop(src, x, y, w, h, dst):
+    """extract w x h crop at (x, y) of src and write as DNG to dst, the
+    crop is aligned to the CFA repeat (relative to the active area) so the
+    CFA pattern phase is kept, ActiveArea and DefaultCrop are adjusted
+
+    returns the DNG_Image written
+    """
+
+    with open(src, 'rb') as fn:
+        rd = ltiff.TIFF_Reader(fn)
+        d = find_raw(rd)
+        width = d.value(0x0100)
+        height = d.value(0x0101)
+
+        ry, rx = (2, 2)
+        if 0x828D in d.entries:
+            ry, rx = d.entries[0x828D].values()[:2]
+        if 0xC68D in d.entries:
+            at, al, ab, ar = _ints(d.entries[0xC68D])
+        else:
+            at, al, ab, ar = 0, 0, height, width
+
+        # align to CFA repeat relative to the active area, with even
+        # size for DNG_Image, and keep inside image
+        if rx % 2:
+            rx *= 2
+        if ry % 2:
+            ry *= 2
+        x = al + ((x - al)/rx)*rx
+        y = at + ((y - at)/ry)*ry
+        if x < 0:
+            x %= rx
+        if y < 0:
+            y %= ry
+        w = min(((w + rx - 1)/rx)*rx, (width - x)/rx*rx)
+        h = min(((h + ry - 1)/ry)*ry, (height - y)/ry*ry)
+        if w <= 0 or h <= 0:
+            raise ltiff.TiffException("crop outside of image")
+
+        data = read_roi(fn, rd, d, x, y, w, h)
+
+        mn, mx = min(data), max(data)
+        if sys.byteorder == 'little':
+            data.byteswap()
+
+        img = ldng.DNG_Image()
+        img.set_raw(w, h, data.tostring(), mn, mx)
+        data = None
+        img.set_model('gen_dng', 'test-crop')
+
+        # calibration from source
+        for tag in raw_tags + cam_tags:
+            e = d.entries.get(tag)
+            if e is None and tag in cam_tags:
+                e = rd.dirs[0].entries.get(tag)
+            if e is None or e.tpe not in ltiff.IDF_tag.emit_desc:
+                continue
+            img.add_tag(tag, list(e.values()), tpe=e.tpe, cnt=e.cnt)
+
+        # active area and default crop, absolute coordinates first
+        nt, nl = max(at, y), max(al, x)
+        nb, nr = min(ab, y + h), min(ar, x + w)
+        if nt >= nb or nl >= nr:
+            nt, nl, nb, nr = y, x, y + h, x + w
+
+        cx, cy, cw, ch = 0, 0, ar - al, ab - at
+        if 0xC61F in d.entries:
+            cx, cy = _ints(d.entries[0xC61F])
+        if 0xC620 in d.entries:
+            cw, ch = _ints(d.entries[0xC620])
+        cl, ct = max(al + cx, nl), max(at + cy, nt)
+        cr, cb = min(al + cx + cw, nr), min(at + cy + ch, nb)
+        if cl >= cr or ct >= cb:
+            cl, ct, cr, cb = nl, nt, nr, nb
+
+        img.add_tag(0xc68d, [nt - y, nl - x, nb - y, nr - x])
+        img.add_tag(0xc61f, [cl - nl, ct - nt])
+        img.add_tag(0xc620, [cr - cl, cb - ct])
+
+    tif = ltiff.TIFF()
+    tif.add_image(img)
+    tif.write(dst)
+    return img
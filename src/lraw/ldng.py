@@ -2,13 +2,16 @@
 #
 # Use 'big-endian' convention
 
-import sys, struct, time, hashlib, math
+import sys, struct, time, hashlib, math, ctypes
+import multiprocessing as mp
 from array import array
 from lraw import ltiff
 
 
 class DNG_Image(ltiff.Image):
 
+    cfa_pattern = (1, 0, 2, 1)      # GR,BG - colour of the 2x2 CFA sites
+
     def __init__(self):
         ltiff.Image.__init__(self)
 
@@ -25,14 +28,47 @@ class DNG_Image(ltiff.Image):
         h - image height
         data - array with RGB numbers, std. Bayer filter will be applied
         """
+        assert (w % 2) == 0 and (h % 2) == 0, \
+            "expect even image size"
+
+        # apply color filter to RGB image and pack into byte array
+        txt, mn, mx = self.convert_data(w, h, data)
+        self.set_raw(w, h, txt, mn, mx)
+
+
+    def set_pattern(self, w, h, pattern, nproc=1):
+        """set image size and data from pattern evaluated at the CFA
+        sites only, i.e. without building the RGB image
+
+        usage: set_pattern(self, w, h, pattern, nproc=1)
+        pattern - function (row, chn) -> w samples of channel chn
+        nproc - if > 1, no. of processes filling a shared buffer,
+                see mosaic_shared
+        """
+
+        if nproc > 1:
+            txt, mn, mx = self.mosaic_shared(w, h, pattern, nproc)
+        else:
+            txt, mn, mx = self.mosaic(w, h, pattern)
+        self.set_raw(w, h, txt, mn, mx)
+
+
+    def set_raw(self, w, h, txt, mn, mx):
+        """set image size and already mosaiced data, e.g. as returned
+        by convert_data, and some sub-set of tags
+
+        usage: set_raw(self, w, h, txt, mn, mx)
+        w - image width
+        h - image height
+        txt - packed big-endian 16-bit CFA samples
+        mn, mx - min. and max. sample value
+        """
         ns_px = 1
         nbps = 16
 
         assert (w % 2) == 0 and (h % 2) == 0, \
             "expect even image size"
 
-        # apply color filter to RGB image and pack into byte array
-        txt, mn, mx = self.convert_data(w, h, data)
         super(DNG_Image, self).set_data(w, h, ns_px, nbps, mn, mx, txt)
 
         # populate TIFF fields
@@ -42,7 +78,7 @@ class DNG_Image(ltiff.Image):
         self.add_tag(0x011C, 1)         # Planar config: chunky
 
         self.add_tag(0x828d, [2,2])         # CFA repeat dim
-        self.add_tag(0x828e, [1, 0, 2, 1])  # CFA Pattern  - Bayer
+        self.add_tag(0x828e, list(self.cfa_pattern))  # CFA Pattern  - Bayer
         self.add_tag(0xc617, 1)             # Layout - rectangleg
 
         a, b = [1,1], [1,1]
@@ -89,7 +125,12 @@ class DNG_Image(ltiff.Image):
         self.add_tag(0x9003, txt)
         self.add_tag(0x9004, txt)
 
-        # image digest
+        self.set_digest()
+
+
+    def set_digest(self):
+        "(re-)compute raw image digest from data"
+
         alg = hashlib.md5()
         alg.update(self.data)
         txt = alg.digest()
@@ -98,6 +139,97 @@ class DNG_Image(ltiff.Image):
 
 
 
+    @classmethod
+    def mosaic(cls, w, h, pattern, buf=None):
+        """evaluate pattern at the CFA sites and pack into byte array,
+        same result as convert_data on the full RGB image
+
+        usage: txt, mn, mx = mosaic(w, h, pattern)
+        pattern - function (row, chn) -> sequence of w samples of row,
+                  for colour channel chn (0 - R, 1 - G, 2 - B)
+        buf - optional array('H') of w*h samples to fill, re-used
+        """
+
+        if buf is None:
+            buf = array('H', [0])*(w*h)
+        cls._mosaic_rows(w, 0, h, pattern, buf)
+
+        mn, mx = min(buf), max(buf)
+
+        if sys.byteorder == 'little':
+            buf.byteswap()
+        txt = buf.tostring()
+        if sys.byteorder == 'little':
+            buf.byteswap()
+
+        return txt, mn, mx
+
+
+    @classmethod
+    def mosaic_shared(cls, w, h, pattern, nproc):
+        """as mosaic, but nproc worker processes fill disjoint row bands
+        of a buffer in shared memory, nothing is pickled back to the parent
+
+        usage: data, mn, mx = mosaic_shared(w, h, pattern, nproc)
+        data - buffer on the shared memory, can be hashed and written
+               without a copy
+        """
+
+        shm = mp.RawArray('H', w*h)
+        res = mp.Queue()
+
+        # bands of even no. of rows, to keep the CFA phase
+        nrow = 2*((h/2 + nproc - 1)/nproc)
+        bands = [(j0, min(j0 + nrow, h)) for j0 in range(0, h, nrow)]
+
+        def worker(j0, j1):
+            # one row at a time, moved straight into the shared memory
+            row = array('H', [0])*w
+            addr = row.buffer_info()[0]
+            base = ctypes.addressof(shm)
+            mn, mx = 0xFFFF, 0
+            for jj in range(j0, j1):
+                cls._mosaic_rows(w, jj, jj + 1, pattern, row)
+                mn = min(mn, min(row))
+                mx = max(mx, max(row))
+
+                if sys.byteorder == 'little':
+                    row.byteswap()
+                ctypes.memmove(base + 2*w*jj, addr, 2*w)
+            res.put((mn, mx))
+
+        procs = [mp.Process(target=worker, args=band) for band in bands]
+        for p in procs:
+            p.start()
+
+        for p in procs:
+            p.join()
+        if any(p.exitcode != 0 for p in procs):
+            raise ltiff.TiffException("mosaic worker failed")
+
+        lims = [res.get() for p in procs]
+
+        mn = min(l[0] for l in lims)
+        mx = max(l[1] for l in lims)
+        return buffer(shm), mn, mx
+
+
+    @classmethod
+    def _mosaic_rows(cls, w, j0, j1, pattern, buf):
+        "fill buf with CFA samples of rows j0 .. j1-1, buf starts at row j0"
+
+        cfa = cls.cfa_pattern
+        for jj in range(j0, j1):
+            ofs = w*(jj - j0)
+            c0 = cfa[2*(jj & 1)]
+            c1 = cfa[2*(jj & 1) + 1]
+
+            vals = pattern(jj, c0)
+            buf[ofs:ofs+w:2] = array('H', vals[0::2])
+            vals = pattern(jj, c1)
+            buf[ofs+1:ofs+w:2] = array('H', vals[1::2])
+
+
     @staticmethod
     def convert_data(w, h, data):
         """take RGB array, apply Bayer filter and pack into byte array
@@ -142,3 +274,100 @@ class DNG_Image(ltiff.Image):
             buf.byteswap()
 
         return buf.tostring(),mn,mx
+
+
+
+class DNG_Sequence(object):
+    """CinemaDNG style frame sequence, all frames share one mosaic buffer
+    and one DNG_Image as tag template, per frame only the rows that
+    changed and the per-frame tags are recomputed
+
+    usage: seq = DNG_Sequence(w, h, fps)
+           seq.img.set_model(..)
+           for t in range(n):
+               img = seq.set_frame(t, pattern, row_key)
+               ... write img
+
+    pattern - function (row, chn) -> w samples of channel chn, see
+              DNG_Image.mosaic
+    row_key - function (row) -> key, rows with the same key have the
+              same samples, in this and in other frames
+
+    Black and white level are taken from the first frame.
+    """
+
+    def __init__(self, w, h, fps):
+        assert (w % 2) == 0 and (h % 2) == 0, \
+            "expect even image size"
+
+        self.width = w
+        self.height = h
+        self.fps = fps
+        self.nframe = 0
+
+        self.img = DNG_Image()
+        self.buf = array('H', [0])*(w*h)   # big-endian samples
+        self.keys = h*[None]
+        self.lims = h*[None]
+
+
+    def set_frame(self, t, pattern, row_key):
+        """update buffer and tags to frame t, returns the DNG_Image
+
+        self.nrows is set to the no. of rows updated
+        """
+
+        w = self.width
+        buf = self.buf
+        rows = {}
+        row = array('H', [0])*w
+
+        self.nrows = 0
+        for jj in range(self.height):
+            key = (row_key(jj), jj & 1)
+            if self.keys[jj] == key:
+                continue
+
+            if key not in rows:
+                DNG_Image._mosaic_rows(w, jj, jj+1, pattern, row)
+                lim = (min(row), max(row))
+                if sys.byteorder == 'little':
+                    row.byteswap()
+                rows[key] = (array('H', row), lim)
+
+            ofs = w*jj
+            buf[ofs:ofs+w], self.lims[jj] = rows[key]
+            self.keys[jj] = key
+            self.nrows += 1
+
+        img = self.img
+        if self.nframe == 0:
+            mn = min(l[0] for l in self.lims)
+            mx = max(l[1] for l in self.lims)
+            img.set_raw(w, self.height, buf.tostring(), mn, mx)
+        else:
+            # data replaced, drop strip tags of an earlier compress
+            img.data = buf.tostring()
+            img.reset_strips()
+            img.set_digest()
+
+        num, den = int(round(1000*self.fps)), 1000
+        img.add_rat_tag(0xC764, [num], [den])
+        img.add_tag(0xC763, self.timecode(t))
+
+        self.nframe += 1
+        return img
+
+
+    def timecode(self, t):
+        "SMPTE time code of frame t, as 8 bytes of BCD (non-drop frame)"
+
+        def bcd(v):
+            return ((v / 10) << 4) | (v % 10)
+
+        fps = int(round(self.fps))
+        ff = t % fps
+        ss = (t / fps) % 60
+        mm = (t / (60*fps)) % 60
+        hh = (t / (3600*fps)) % 24
+        return [bcd(ff), bcd(ss), bcd(mm), bcd(hh), 0, 0, 0, 0]
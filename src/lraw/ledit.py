@@ -0,0 +1,163 @@
+# -*- coding: utf8 -*-
+#
+# In-place tag editing of existing tiff/dng files: the edited IDF is
+# written at the end of the file and the link to it re-pointed, the
+# image data is not touched
+
+import struct
+from lraw import ltiff
+
+
+class TIFF_Editor(object):
+    """edit tags of existing tiff/dng file
+
+    usage:
+      with TIFF_Editor(fname) as ed:
+          ed.set_tag(0xC61A, 1024)
+          ed.set_rat_tag(0xC628, [1,1,1], [2,1,2])
+
+    IDFs are selected by idx into ed.dirs (main chain, SubIFDs following
+    their parent), by default the first IDF that has the tag already,
+    else the first IDF. Changes are written by commit, or on close,
+    but not if the with body raised an exception.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.fn = open(fname, 'r+b')
+        self._parse()
+
+
+    def _parse(self):
+        self.rd = ltiff.TIFF_Reader(self.fn)
+        self.bo = self.rd.bo
+        self.dirs = self.rd.all_dirs()
+        self.changes = {}               # idx -> {tag : IDF_tag or None}
+
+
+    def find(self, tag):
+        "idx of first IDF with tag, or 0"
+        for jj, d in enumerate(self.dirs):
+            if tag in d.entries:
+                return jj
+        return 0
+
+
+    def set_tag(self, tag, value, tpe=None, cnt=None, idx=None):
+        "set (or add) tag, arguments as for ltiff.Image.add_tag"
+
+        if idx is None:
+            idx = self.find(tag)
+        if tpe is None and tag not in ltiff.TIFF_tags and \
+                tag in self.dirs[idx].entries:
+            tpe = self.dirs[idx].entries[tag].tpe
+
+        e = ltiff.IDF_tag(tag, value, tpe=tpe, cnt=cnt)
+        self.changes.setdefault(idx, {})[tag] = e
+
+
+    def set_rat_tag(self, tag, a, b, tpe=None, idx=None):
+        "set RATIONAL or SRATIONAL tag from a and b"
+
+        assert len(a) == len(b), "a and b length mis-match"
+
+        val = []
+        for jj in range(len(a)):
+            val.append(a[jj])
+            val.append(b[jj])
+        self.set_tag(tag, val, tpe=tpe, idx=idx)
+
+
+    def del_tag(self, tag, idx=None):
+        if idx is None:
+            idx = self.find(tag)
+        self.changes.setdefault(idx, {})[tag] = None
+
+
+    def commit(self):
+        """write edited IDFs at end of file and re-point the links to them,
+        SubIFDs first, so a re-written parent links to the new SubIFDs
+        """
+
+        if not self.changes:
+            return
+
+        for idx in sorted(self.changes.keys(), reverse=True):
+            d = self.dirs[idx]
+            ofs = self._write_dir(d, self.changes[idx])
+            self.fn.seek(d.link_ofs)
+            self.fn.write(struct.pack(self.bo + "I", ofs))
+            d.IDF_ofs = ofs
+
+        self.fn.flush()
+        self._parse()
+
+
+    def close(self, commit=True):
+        "commit pending changes, unless commit is False, and close file"
+        if self.fn is not None:
+            try:
+                if commit:
+                    self.commit()
+            finally:
+                self.fn.close()
+                self.fn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tpe, value, tb):
+        # changes of a failed with body are dropped
+        self.close(commit=tpe is None)
+
+
+    # ---------------------------------------------------------
+    def _write_dir(self, d, changes):
+        "write IDF d with changes applied at end of file, returns offset"
+
+        bo = self.bo
+        fn = self.fn
+
+        # (tag, type, count, value bytes) of all entries
+        ents = {}
+        for tag, e in d.entries.items():
+            ents[tag] = (tag, e.tpe, e.cnt, e.txt)
+        for tag, e in changes.items():
+            if e is None:
+                ents.pop(tag, None)
+            else:
+                ents[tag] = (tag, e.tpe, e.cnt, e._pack(bo))
+        if 0x014A in ents and d.sub:
+            sub = [s.IDF_ofs for s in d.sub]
+            ents[0x014A] = (0x014A, ltiff.UINT32, len(sub),
+                struct.pack(bo + "{0}I".format(len(sub)), *sub))
+
+        fn.seek(0, 2)
+        ofs = fn.tell()
+        if ofs % 2:
+            fn.write(chr(0))
+            ofs += 1
+
+        next_ofs = self.rd._read_u32(d.next_link_ofs)
+        keyl = sorted(ents.keys())
+        val_ofs = ofs + 2 + 12*len(keyl) + 4
+
+        idf = [struct.pack(bo + "H", len(keyl))]
+        vals = []
+        for tag in keyl:
+            tag, tpe, cnt, txt = ents[tag]
+            if len(txt) <= 4:
+                idf.append(struct.pack(bo + "HHI", tag, tpe, cnt) +
+                    txt + (4 - len(txt))*chr(0))
+            else:
+                idf.append(struct.pack(bo + "HHII", tag, tpe, cnt, val_ofs))
+                if len(txt) % 2:
+                    txt = txt + chr(0)
+                vals.append(txt)
+                val_ofs += len(txt)
+        idf.append(struct.pack(bo + "I", next_ofs))
+
+        fn.seek(ofs)
+        fn.write(''.join(idf))
+        fn.write(''.join(vals))
+        return ofs
@@ -0,0 +1,239 @@
+# -*- coding: utf8 -*-
+#
+# Fuzz-corpus mutator: patch header/IDF bytes of an encoded tiff/dng,
+# the image data is never re-encoded and never copied
+
+import os, struct, random, bisect
+from cStringIO import StringIO
+from lraw import ltiff
+
+
+class Variant(object):
+    """mutated file, i.e. patched copies of the header/IDF/value ranges
+    joined with buffers on the unchanged base data in between
+
+    desc  - text describing the mutation
+    parts - list of bytearray/buffer, in file order
+    """
+
+    def __init__(self, desc, parts):
+        self.desc = desc
+        self.parts = parts
+
+    def __len__(self):
+        return sum(len(p) for p in self.parts)
+
+    def write_fn(self, fn):
+        for p in self.parts:
+            fn.write(p)
+
+    def tostring(self):
+        return ''.join(str(p) for p in self.parts)
+
+
+
+class Mutator(object):
+    """encode base file once, then produce mutated variants by patching
+    copies of the header, IDFs and value blocks only, wherever these are
+    in the file (e.g. IDFs following the image data)
+
+    usage: mut = Mutator(txt)
+           for v in mut.variants(n, seed=0):
+               v.write_fn(fn)
+    txt - complete tiff/dng file as string
+    """
+
+    # tag types to use for bogus types, incl. invalid ones
+    bogus_types = (0, 1, 2, 3, 4, 5, 7, 12, 13, 14, 0x00FF, 0xFFFF)
+
+    def __init__(self, txt):
+        self.base = txt
+        self.size = len(txt)
+
+        rd = ltiff.TIFF_Reader(StringIO(txt))
+        self.bo = rd.bo
+        self.dirs = rd.all_dirs()
+
+        # patchable (ofs, len) ranges - header, IDFs and value blocks,
+        # overlapping or adjacent ranges merged
+        rngs = [(0, 8)]
+        for d in self.dirs:
+            rngs.append((d.IDF_ofs, d.next_link_ofs + 4 - d.IDF_ofs))
+            for e in d.entries.values():
+                if not e.inline and e.nbytes:
+                    rngs.append((e.val_ofs, e.nbytes))
+
+        self.ranges = []
+        for ofs, n in sorted(rngs):
+            end = min(ofs + n, self.size)
+            if self.ranges and ofs <= self.ranges[-1][1]:
+                lo, hi = self.ranges[-1]
+                self.ranges[-1] = (lo, max(hi, end))
+            else:
+                self.ranges.append((ofs, end))
+        self.ranges = [(lo, hi - lo) for lo, hi in self.ranges]
+        self.starts = [ofs for ofs, n in self.ranges]
+
+        self.entries = [(d, e) for d in self.dirs for e in d.entries.values()]
+        self.ext = [(d, e) for (d, e) in self.entries if not e.inline]
+        self.blks = [(ofs, n) for d in self.dirs for ofs, n in d.strips()
+                     if n and ofs + n <= self.size]
+
+        self.ops = [self.op_count, self.op_type, self.op_offset,
+            self.op_strip, self.op_truncate, self.op_nentries, self.op_link,
+            self.op_tag]
+
+
+    def variant(self, rnd):
+        "one random mutation, returns Variant"
+
+        patch = {}
+        op = rnd.choice(self.ops)
+        desc, size = op(rnd, patch)
+
+        # patched ranges, base buffers in between, cut at size
+        parts = []
+        pos = 0
+        for ofs in sorted(patch):
+            if ofs >= size:
+                break
+            if ofs > pos:
+                parts.append(buffer(self.base, pos, ofs - pos))
+            blk = patch[ofs]
+            parts.append(blk[:size - ofs] if ofs + len(blk) > size else blk)
+            pos = ofs + len(blk)
+        if pos < size:
+            parts.append(buffer(self.base, pos, size - pos))
+        return Variant(desc, parts)
+
+
+    def variants(self, n, seed=0):
+        "generator of n random variants, reproducible from seed"
+
+        rnd = random.Random(seed)
+        for jj in range(n):
+            yield self.variant(rnd)
+
+
+    def write(self, dname, n, seed=0, prefix='fuzz', ext='.dng'):
+        """write n variants to directory dname, with index file listing
+        the mutation of each file, returns the list of file names
+        """
+
+        if not os.path.isdir(dname):
+            os.makedirs(dname)
+
+        fnames = []
+        with open(os.path.join(dname, prefix + '.txt'), 'w') as idx:
+            for jj, v in enumerate(self.variants(n, seed)):
+                fname = "{0}_{1:05d}{2}".format(prefix, jj, ext)
+                with open(os.path.join(dname, fname), 'wb') as fn:
+                    v.write_fn(fn)
+                idx.write("{0} {1}\n".format(fname, v.desc))
+                fnames.append(fname)
+        return fnames
+
+
+    # ---------------------------------------------------------
+    # mutation operators: op(rnd, patch) -> desc, size, patch is the
+    # dictionary range offset -> patched copy, size the variant size
+
+    def _put(self, patch, ofs, fmt, val):
+        "pack val at file offset ofs, into a copy of the enclosing range"
+        jj = bisect.bisect_right(self.starts, ofs) - 1
+        start, n = self.ranges[jj]
+        if start not in patch:
+            patch[start] = bytearray(self.base[start:start + n])
+        struct.pack_into(self.bo + fmt, patch[start], ofs - start, val)
+
+    @staticmethod
+    def _path(d, e):
+        return "IDF@0x{0:X} tag=0x{1:04X}".format(d.IDF_ofs, e.tag)
+
+
+    def op_count(self, rnd, patch):
+        "wrong value count"
+        d, e = rnd.choice(self.entries)
+        cnt = rnd.choice((0, 1, max(e.cnt - 1, 0), e.cnt + 1, 2*e.cnt,
+            0xFFFF, 0x7FFFFFFF, 0xFFFFFFFF))
+        self._put(patch, e.ofs + 4, "I", cnt)
+        return "count {0} {1} -> {2}".format(
+            self._path(d, e), e.cnt, cnt), self.size
+
+
+    def op_type(self, rnd, patch):
+        "bogus tag type"
+        d, e = rnd.choice(self.entries)
+        tpe = rnd.choice(self.bogus_types)
+        self._put(patch, e.ofs + 2, "H", tpe)
+        return "type {0} {1} -> {2}".format(
+            self._path(d, e), e.tpe, tpe), self.size
+
+
+    def op_offset(self, rnd, patch):
+        "bad value offset"
+        if not self.ext:
+            return self.op_count(rnd, patch)
+        d, e = rnd.choice(self.ext)
+        ofs = rnd.choice((0, 1, e.val_ofs + 1, self.size - 1, self.size,
+            0x7FFFFFFF, 0xFFFFFFFF))
+        self._put(patch, e.ofs + 8, "I", ofs)
+        return "offset {0} 0x{1:X} -> 0x{2:X}".format(
+            self._path(d, e), e.val_ofs, ofs), self.size
+
+
+    def op_strip(self, rnd, patch):
+        "bad strip/tile offset or byte count"
+        tab = [(d, e) for (d, e) in self.entries
+               if e.tag in (0x0111, 0x0117, 0x0144, 0x0145)
+               and e.tpe in (3, 4) and e.cnt]
+        if not tab:
+            return self.op_count(rnd, patch)
+
+        d, e = rnd.choice(tab)
+        jj = rnd.randrange(e.cnt)
+        nby, fmt = ltiff.type_desc[e.tpe]
+        mx = 0xFFFF if e.tpe == 3 else 0xFFFFFFFF
+        old = e.values()[jj]
+        val = rnd.choice((0, old + 1, old - 1 if old else 1, self.size,
+            mx)) & mx
+        self._put(patch, e.val_ofs + nby*jj, fmt, val)
+        return "strip {0}[{1}] {2} -> {3}".format(
+            self._path(d, e), jj, old, val), self.size
+
+
+    def op_truncate(self, rnd, patch):
+        "truncated image data, cut inside a strip/tile"
+        if not self.blks:
+            return self.op_count(rnd, patch)
+        ofs, n = rnd.choice(self.blks)
+        size = ofs + rnd.randrange(n)
+        return "truncate {0} -> {1} bytes".format(self.size, size), size
+
+
+    def op_nentries(self, rnd, patch):
+        "wrong no. of IDF entries"
+        d = rnd.choice(self.dirs)
+        n = len(d.entries)
+        val = rnd.choice((0, 1, n - 1, n + 1, 0xFFFF))
+        self._put(patch, d.IDF_ofs, "H", val)
+        return "nentries IDF@0x{0:X} {1} -> {2}".format(
+            d.IDF_ofs, n, val), self.size
+
+
+    def op_link(self, rnd, patch):
+        "bad IDF link, incl. loops"
+        d = rnd.choice(self.dirs)
+        val = rnd.choice((d.IDF_ofs, d.IDF_ofs + 1, self.size, 0xFFFFFFFF))
+        self._put(patch, d.next_link_ofs, "I", val)
+        return "link IDF@0x{0:X} -> 0x{1:X}".format(d.IDF_ofs, val), self.size
+
+
+    def op_tag(self, rnd, patch):
+        "changed tag id, i.e. unknown, duplicate or out of order"
+        d, e = rnd.choice(self.entries)
+        other = rnd.choice(d.entries.keys())
+        tag = rnd.choice((0, other, e.tag + 1, 0xFFFF))
+        self._put(patch, e.ofs, "H", tag)
+        return "tag {0} -> 0x{1:04X}".format(
+            self._path(d, e), tag), self.size
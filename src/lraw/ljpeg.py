@@ -0,0 +1,219 @@
+# -*- coding: utf8 -*-
+#
+# minimal lossless JPEG (ITU T.81, process 14, SOF3) decoder, as used
+# for compression=7 tiles/strips of DNG files
+
+import struct
+from array import array
+from lraw import ltiff
+
+
+class Huffman(object):
+    """huffman table, decoded with 16-bit look-up table
+
+    lut[code16] = (code length, value)
+    """
+
+    def __init__(self, counts, values):
+        self.lut = [(0, 0)]*(1 << 16)
+
+        code = 0
+        k = 0
+        for l in range(1, 17):
+            for jj in range(counts[l-1]):
+                v = values[k]
+                k += 1
+                lo = code << (16 - l)
+                hi = (code + 1) << (16 - l)
+                for c in range(lo, hi):
+                    self.lut[c] = (l, v)
+                code += 1
+            code <<= 1
+
+
+
+def _segments(txt):
+    "split into (marker, payload) up to and incl. SOS, and scan data offset"
+
+    pos = 2
+    if txt[:2] != '\xff\xd8':
+        raise ltiff.TiffException("ljpeg: missing SOI")
+
+    segs = []
+    while pos < len(txt):
+        while txt[pos] == '\xff' and txt[pos+1] == '\xff':
+            pos += 1
+        mrk = struct.unpack(">H", txt[pos:pos+2])[0]
+        n = struct.unpack(">H", txt[pos+2:pos+4])[0]
+        segs.append((mrk, txt[pos+4:pos+2+n]))
+        pos += 2 + n
+        if mrk == 0xFFDA:
+            return segs, pos
+    raise ltiff.TiffException("ljpeg: missing SOS")
+
+
+def _unstuff(txt, pos):
+    """entropy coded data from pos, with stuffed 0xFF00 removed,
+    returns list of segments split at restart markers
+    """
+
+    parts = []
+    cur = bytearray()
+    n = len(txt)
+    while pos < n:
+        jj = txt.find('\xff', pos)
+        if jj < 0 or jj + 1 >= n:
+            cur.extend(txt[pos:])
+            break
+        cur.extend(txt[pos:jj])
+        nxt = ord(txt[jj+1])
+        if nxt == 0:
+            cur.append(0xFF)
+        elif 0xD0 <= nxt <= 0xD7:
+            parts.append(cur)
+            cur = bytearray()
+        elif nxt == 0xFF:
+            pos = jj + 1
+            continue
+        else:
+            break                   # EOI or other marker
+        pos = jj + 2
+    parts.append(cur)
+    return parts
+
+
+def decode(txt):
+    """decode lossless JPEG
+
+    usage: data, w, h = decode(txt)
+    data - array('H') of samples, components interleaved
+    w    - no. of samples per line, i.e. width*no. of components
+    h    - no. of lines
+    """
+
+    segs, pos = _segments(txt)
+
+    tables = {}
+    frame = None
+    restart = 0
+    for mrk, pl in segs:
+        if mrk == 0xFFC4:                           # DHT
+            ofs = 0
+            while ofs < len(pl):
+                tc_th = ord(pl[ofs])
+                counts = [ord(c) for c in pl[ofs+1:ofs+17]]
+                nv = sum(counts)
+                values = [ord(c) for c in pl[ofs+17:ofs+17+nv]]
+                tables[tc_th & 0x0F] = Huffman(counts, values)
+                ofs += 17 + nv
+        elif mrk == 0xFFC3:                         # SOF3
+            prec, h, w, nc = struct.unpack(">BHHB", pl[:6])
+            frame = (prec, h, w, nc)
+        elif mrk in (0xFFC0, 0xFFC1, 0xFFC2, 0xFFC5, 0xFFC6, 0xFFC7):
+            raise ltiff.TiffException("ljpeg: not a lossless JPEG")
+        elif mrk == 0xFFDD:                         # DRI
+            restart = struct.unpack(">H", pl[:2])[0]
+        elif mrk == 0xFFDA:                         # SOS
+            ns = ord(pl[0])
+            tab = [tables[ord(pl[2+2*jj]) >> 4] for jj in range(ns)]
+            pred = ord(pl[1+2*ns])
+            pt = ord(pl[3+2*ns]) & 0x0F
+
+    if frame is None:
+        raise ltiff.TiffException("ljpeg: missing SOF3")
+
+    prec, h, w, nc = frame
+    if ns != nc:
+        raise ltiff.TiffException("ljpeg: non-interleaved scans")
+
+    return _decode_scan(_unstuff(txt, pos), tab, pred, prec, pt,
+        w, h, nc, restart), w*nc, h
+
+
+def _decode_scan(parts, tab, pred, prec, pt, w, h, nc, restart):
+    ncol = w*nc
+    out = array('H', [0])*(ncol*h)
+    msk = (1 << 16) - 1
+    dflt = 1 << (prec - pt - 1)
+    luts = [t.lut for t in tab]
+
+    part = 0
+    buf = parts[0]
+    pos = 0
+    acc = 0
+    nbits = 0
+    first = 0                   # first line of current restart interval
+    nmcu = 0
+
+    for jj in range(h):
+        ofs = jj*ncol
+        for kk in range(w):
+            if restart and nmcu == restart:
+                # next restart interval, reset bit reader and prediction
+                part += 1
+                buf = parts[part] if part < len(parts) else bytearray()
+                pos = 0
+                acc = 0
+                nbits = 0
+                nmcu = 0
+                first = jj
+            nmcu += 1
+
+            for c in range(nc):
+                # huffman decode SSSS
+                while nbits < 16:
+                    acc = (acc << 8) | (buf[pos] if pos < len(buf) else 0)
+                    pos += 1
+                    nbits += 8
+                l, s = luts[c][(acc >> (nbits - 16)) & 0xFFFF]
+                if l == 0:
+                    raise ltiff.TiffException("ljpeg: bad huffman code")
+                nbits -= l
+
+                if s == 0:
+                    diff = 0
+                elif s == 16:
+                    diff = 32768
+                else:
+                    while nbits < s:
+                        acc = (acc << 8) | (buf[pos] if pos < len(buf) else 0)
+                        pos += 1
+                        nbits += 8
+                    v = (acc >> (nbits - s)) & ((1 << s) - 1)
+                    nbits -= s
+                    if v < (1 << (s - 1)):
+                        v -= (1 << s) - 1
+                    diff = v
+                acc &= (1 << nbits) - 1
+
+                # prediction
+                i = ofs + kk*nc + c
+                if jj == first:
+                    p = dflt if kk == 0 else out[i - nc]
+                elif kk == 0:
+                    p = out[i - ncol]
+                else:
+                    ra = out[i - nc]
+                    rb = out[i - ncol]
+                    rc = out[i - ncol - nc]
+                    if pred == 1:
+                        p = ra
+                    elif pred == 2:
+                        p = rb
+                    elif pred == 3:
+                        p = rc
+                    elif pred == 4:
+                        p = ra + rb - rc
+                    elif pred == 5:
+                        p = ra + ((rb - rc) >> 1)
+                    elif pred == 6:
+                        p = rb + ((ra - rc) >> 1)
+                    else:
+                        p = (ra + rb) >> 1
+
+                out[i] = (p + diff) & msk
+
+    if pt:
+        for i in range(len(out)):
+            out[i] = (out[i] << pt) & msk
+    return out
@@ -0,0 +1,173 @@
+# -*- coding: utf8 -*-
+#
+# Sidecar manifest with the hashes of the IDFs and strips/tiles of a
+# tiff file, allows to compare files without reading the image data
+
+import os, json, hashlib, struct
+from lraw import ltiff
+
+version = 1
+chunk = 1 << 20         # read size when hashing strips from file
+
+
+def name(fname):
+    "sidecar file name for fname"
+    return fname + '.manifest'
+
+
+def _md5_range(fn, ofs, n):
+    alg = hashlib.md5()
+    fn.seek(ofs)
+    while n > 0:
+        txt = fn.read(min(n, chunk))
+        if not txt:
+            break
+        alg.update(txt)
+        n -= len(txt)
+    return alg.hexdigest()
+
+
+def _tag_digest(e):
+    "hash of tag entry, i.e. tag, type, count and value - not the location"
+    alg = hashlib.md5()
+    alg.update(struct.pack(">HHI", e.tag, e.tpe, e.cnt))
+    alg.update(e.txt)
+    return alg.hexdigest()
+
+
+def build(fname, known=None):
+    """build manifest for file
+
+    usage: man = build(fname, known=None)
+    known - optional dictionary offset -> md5 hex digest of strips already
+            known, e.g. by the writer, these are not read from the file
+    """
+
+    if known is None:
+        known = {}
+
+    man = {'version' : version, 'alg' : 'md5',
+        'size' : os.path.getsize(fname), 'dirs' : []}
+
+    with open(fname, 'rb') as fn:
+        rd = ltiff.TIFF_Reader(fn)
+
+        def add(d, path):
+            tags = {}
+            alg = hashlib.md5()
+            for tag in sorted(d.entries.keys()):
+                txt = _tag_digest(d.entries[tag])
+                tags["0x{0:04X}".format(tag)] = txt
+                alg.update(txt)
+
+            strips = []
+            for ofs, n in d.strips():
+                txt = known.get(ofs)
+                if txt is None:
+                    txt = _md5_range(fn, ofs, n)
+                strips.append([ofs, n, txt])
+
+            man['dirs'].append({'path' : path, 'ofs' : d.IDF_ofs,
+                'ifd' : alg.hexdigest(), 'tags' : tags, 'strips' : strips})
+
+            for jj, s in enumerate(d.sub):
+                add(s, "{0}.{1}".format(path, jj))
+
+        for jj, d in enumerate(rd.dirs):
+            add(d, str(jj))
+
+    return man
+
+
+def write(fname, known=None):
+    "build manifest for fname and write it as sidecar"
+
+    man = build(fname, known=known)
+    with open(name(fname), 'w') as fn:
+        json.dump(man, fn, indent=1, sort_keys=True)
+    return man
+
+
+def load(fname):
+    """load sidecar manifest of fname, it's rebuilt (and not written) if
+    missing or out-dated i.e. older than the file or with different size
+    """
+
+    sname = name(fname)
+    if os.path.exists(sname) and \
+            os.path.getmtime(sname) >= os.path.getmtime(fname):
+        with open(sname, 'r') as fn:
+            man = json.load(fn)
+        if man.get('version') == version and \
+                man.get('size') == os.path.getsize(fname):
+            return man
+
+    return build(fname)
+
+
+def _first_diff(fa, fb, sa, sb):
+    "offset of first differing byte of strips sa, sb = (ofs, n, md5)"
+
+    n = min(sa[1], sb[1])
+    pos = 0
+    while pos < n:
+        m = min(n - pos, chunk)
+        fa.seek(sa[0] + pos)
+        fb.seek(sb[0] + pos)
+        ta = fa.read(m)
+        tb = fb.read(m)
+        if ta != tb:
+            for jj in range(m):
+                if ta[jj] != tb[jj]:
+                    return pos + jj
+        pos += m
+    return n
+
+
+def compare(fa, fb):
+    """compare two files via manifest, only mismatching strips are read
+
+    usage: diffs = compare(fa, fb)
+    diffs - list of text lines describing the differences, empty if same
+    """
+
+    ma = load(fa)
+    mb = load(fb)
+
+    diffs = []
+    if len(ma['dirs']) != len(mb['dirs']):
+        diffs.append("no. of IDFs: {0} != {1}".format(
+            len(ma['dirs']), len(mb['dirs'])))
+
+    with open(fa, 'rb') as fna:
+        with open(fb, 'rb') as fnb:
+            for da, db in zip(ma['dirs'], mb['dirs']):
+                path = da['path']
+
+                if da['ifd'] != db['ifd']:
+                    ta, tb = da['tags'], db['tags']
+                    for tag in sorted(set(ta.keys()) | set(tb.keys())):
+                        if tag not in tb:
+                            diffs.append("IDF {0}: tag {1} only in {2}".format(
+                                path, tag, fa))
+                        elif tag not in ta:
+                            diffs.append("IDF {0}: tag {1} only in {2}".format(
+                                path, tag, fb))
+                        elif ta[tag] != tb[tag]:
+                            diffs.append("IDF {0}: tag {1} differs".format(
+                                path, tag))
+
+                sa, sb = da['strips'], db['strips']
+                if len(sa) != len(sb):
+                    diffs.append("IDF {0}: no. of strips {1} != {2}".format(
+                        path, len(sa), len(sb)))
+
+                for jj, (a, b) in enumerate(zip(sa, sb)):
+                    if a[2] == b[2]:
+                        continue
+                    pos = _first_diff(fna, fnb, a, b)
+                    diffs.append("IDF {0}: strip {1} differs @ +{2} "
+                        "(0x{3:08X} / 0x{4:08X}), {5} / {6} bytes".format(
+                        path, jj, pos, a[0] + pos, b[0] + pos, a[1], b[1]))
+
+    return diffs
@@ -2,10 +2,14 @@
 #
 # minimal support to generate TIFF-like file container
 
-import sys, time, struct, types, collections
+import sys, time, struct, types, collections, zlib, hashlib, audioop
 from array import array
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 _debug = False
+_verbose = True         # progress output, cleared by e.g. service mode
+_pool = None            # compression threads, see _get_pool
 
 
 # Tag type enumerate
@@ -50,6 +54,7 @@ TIFF_base_tags = {
     0x011F : RATIONAL,  # Y position
     0x0128 : UINT16,    # resolution unit
     0x0132 : STRING,    # ModifyDate
+    0x013D : UINT16,    # Predictor (1 - none, 2 - horizontal differencing)
     0x0142 : UINT16,    # TileWidth
     0x0143 : UINT16,    # TileLength
     0x0144 : UINT32,    # TileOffsets
@@ -90,6 +95,8 @@ DNG_tags = {
     0xC65C : RATIONAL,  # BestQualityScale
     0xC68D : UINT32,    # ActiveArea
     0xC71C : UINT8,     # RawImageDigest
+    0xC763 : UINT8,     # TimeCodes - CinemaDNG, SMPTE 8 bytes
+    0xC764 : SRATIONAL, # FrameRate - CinemaDNG
     0xA302 : UINT8}     # CFAPattern - n vector
 
 TIFF_tags = TIFF_base_tags.copy()
@@ -170,6 +177,7 @@ class IDF_tag(object):
         self.cnt = cnt
         self.value = value
         self.txt = None
+        self.blk_ofs = None
 
 
     def emit_idfe(self, fn):
@@ -203,6 +211,7 @@ class IDF_tag(object):
 
         # back-patch tag value to point here
         ofs = fn.tell()
+        self.blk_ofs = ofs
         fn.seek(self.val_ofs)
         fn.write(struct.pack(">I", ofs))
         fn.seek(ofs)
@@ -213,13 +222,13 @@ class IDF_tag(object):
 
 
 
-    def _pack(self):
+    def _pack(self, bo='>'):
         cnt = self.cnt
         val = self.value
 
         desc = IDF_tag.emit_desc[self.tpe]
         stride = desc.stride
-        fmt = desc.fmt
+        fmt = bo + desc.fmt[1:]
         if cnt == 1:
             if stride == 1:
                 txt = struct.pack(fmt, val)
@@ -238,6 +247,69 @@ class IDF_tag(object):
         return txt
 
 
+# ---------------------------------------------------------------------
+# strip compression helpers
+
+def _hdiff(txt, w, ns_px, nbps):
+    """horizontal differencing (TIFF predictor 2) of big-endian samples
+    in strip txt, with w pixels of ns_px samples per row
+
+    the differences of the whole strip are taken at once with audioop on
+    32-bit samples, i.e. in C, the low nbps bits of each difference are
+    the predictor output, only the first pixel of each row is restored
+    per row in python
+    """
+
+    tc = 'H' if nbps == 16 else 'B'
+    nby = nbps/8
+    a = array(tc, txt)
+    if nbps == 16 and sys.byteorder == 'little':
+        a.byteswap()
+
+    # audioop samples are signed, the differences modulo 2**nbps are not
+    # affected by that
+    s = audioop.lin2lin(a.tostring(), nby, 4)
+    s = audioop.mul(s, 4, 1.0/(1 << (32 - nbps)))
+    n = 4*ns_px
+    diff = audioop.add(s[n:], audioop.mul(s[:-n], 4, -1), 4)
+
+    step = 4/nby
+    first = 0 if sys.byteorder == 'little' else step - 1
+    d = array(tc, a[:ns_px])
+    d.extend(array(tc, diff)[first::step])
+
+    row_len = w*ns_px
+    for ofs in range(row_len, len(a), row_len):
+        d[ofs:ofs+ns_px] = a[ofs:ofs+ns_px]
+
+    if nbps == 16 and sys.byteorder == 'little':
+        d.byteswap()
+    return d.tostring()
+
+
+def _deflate_strip(args):
+    "compress one strip, args: (txt, level, predictor, w, ns_px, nbps)"
+
+    txt, level, predictor, w, ns_px, nbps = args
+    if predictor:
+        txt = _hdiff(txt, w, ns_px, nbps)
+    return zlib.compress(txt, level)
+
+
+def _get_pool(nthreads):
+    """compression thread pool of nthreads, created on first use and
+    re-used, closing/joining a pool per call costs ~100 ms (py2 pool
+    handler polls at 0.1 s), a pool of other size is replaced
+    """
+
+    global _pool
+    if _pool is None or _pool._processes != nthreads:
+        if _pool is not None:
+            _pool.close()           # workers exit once idle, no join
+        _pool = ThreadPool(nthreads)
+    return _pool
+
+
 # ---------------------------------------------------------------------
 class Image(object):
     """base class for all flavours of images
@@ -284,6 +356,7 @@ class Image(object):
 
         n = len(data)
         self.data = data
+        self.strips = None
         self.width = width
         self.height = height
         self.ns_px = ns_px
@@ -319,6 +392,75 @@ class Image(object):
         self.add_tag(0x0132, txt)
 
 
+    def compress(self, level=6, predictor=False, rows_ps=None, nthreads=None):
+        """deflate compress (compression=8) the image data, strip by strip,
+        must be called after set_data
+
+        usage: compress(level=6, predictor=False, rows_ps=None, nthreads=None)
+          level     - zlib compression level, 1..9
+          predictor - apply horizontal differencing (predictor=2) first
+          rows_ps   - rows/strip, default gives strips of ~256 kB
+          nthreads  - no. of compression threads, default no. of cores
+
+        returns dictionary with raw and compressed size and elapsed time,
+        also kept as self.comp_stats
+
+        note: zlib releases the GIL, the predictor (audioop) does not, so
+        with predictor only the deflate part of each strip runs in parallel
+        """
+
+        assert self.data is not None, "set_data must be called first"
+        assert self.nbps in (8, 16), "expect 8 or 16 bits/sample"
+
+        t0 = time.time()
+        row_len = self.width*self.ns_px*self.nbps/8
+        if rows_ps is None:
+            rows_ps = max(1, (256*1024)/row_len)
+        rows_ps = min(rows_ps, self.height)
+
+        strip_len = rows_ps*row_len
+        n = len(self.data)
+        raw = [self.data[ofs:ofs+strip_len] for ofs in range(0, n, strip_len)]
+
+        args = [(txt, level, predictor, self.width, self.ns_px, self.nbps)
+                for txt in raw]
+        if nthreads is None:
+            nthreads = cpu_count()
+        nthreads = min(nthreads, len(raw))
+
+        # zlib releases the GIL, so threads are enough to scale the
+        # deflate part, the (C) predictor is cheap compared to it
+        if nthreads > 1:
+            self.strips = _get_pool(nthreads).map(_deflate_strip, args)
+        else:
+            self.strips = map(_deflate_strip, args)
+
+        counts = [len(txt) for txt in self.strips]
+
+        self.add_tag(0x0103, 8)                 # deflate
+        self.add_tag(0x013D, 2 if predictor else 1)
+        self.add_tag(0x116, rows_ps)            # rows/strip
+        self.add_tag(0x0117, counts)            # bytes/strip
+        self.add_tag(0x111, len(counts)*[0])    # strip offset - backpatched
+
+        self.comp_stats = {'raw' : n, 'comp' : sum(counts),
+            'nstrips' : len(counts), 'secs' : time.time() - t0}
+        return self.comp_stats
+
+
+    def reset_strips(self):
+        """back to a single uncompressed strip of self.data, i.e. undo
+        compress, e.g. after the data was replaced
+        """
+
+        self.strips = None
+        self.add_tag(0x0103, 1)                 # uncompressed
+        self.IDF.pop(0x013D, None)
+        self.add_tag(0x116, self.height)        # rows/strip
+        self.add_tag(0x0117, len(self.data))    # bytes/strip
+        self.add_tag(0x111, 0)      # strip offset - backpatched
+
+
     # ---------------------------------------------------------
     # output
     def write_IDF(self, fn):
@@ -329,7 +471,8 @@ class Image(object):
 
         #  actual IDF, starting with no. of entries
         self.IDF_ofs = fn.tell()
-        print "IDF @ 0x{0:08X}".format(self.IDF_ofs)
+        if _verbose:
+            print "IDF @ 0x{0:08X}".format(self.IDF_ofs)
 
         # no. of entries in IDF
         txt = struct.pack(">H", len(keyl))
@@ -350,8 +493,12 @@ class Image(object):
             entry.emit_value(fn)
 
 
-    def write_data(self, fn):
+    def write_data(self, fn, blocks=None):
         """write the image data using the supplied struct.pack format
+
+        blocks - optional dictionary (md5, length) -> file offset of
+                 strips already written, identical strips are not
+                 written again but point to the earlier copy
         """
 
         ofs = fn.tell()
@@ -360,21 +507,46 @@ class Image(object):
             fn.write(txt)
 
         self.img_ofs = fn.tell()
-        print "data @ 0x{0:08X}".format(self.img_ofs)
+        if _verbose:
+            print "data @ 0x{0:08X}".format(self.img_ofs)
 
-        fn.write(self.data)
+        if self.strips is None:
+            strips = [self.data]
+        else:
+            strips = self.strips
 
-        n = len(self.data)
+        strip_ofs = []
+        self.strip_md5 = None
+        if blocks is None:
+            for txt in strips:
+                strip_ofs.append(fn.tell())
+                fn.write(txt)
+        else:
+            self.strip_md5 = []
+            for txt in strips:
+                alg = hashlib.md5(txt)
+                key = (alg.digest(), len(txt))
+                self.strip_md5.append(alg.hexdigest())
+                if key not in blocks:
+                    blocks[key] = fn.tell()
+                    fn.write(txt)
+                strip_ofs.append(blocks[key])
+
+        n = fn.tell() - self.img_ofs
         if (n % 4) != 0:
             txt = (n % 4) * chr(0)
             fn.write(txt)
 
-        # back-patch strip offset
+        # back-patch strip offset(s), in IDF or in value block
         ofs = fn.tell()
         entry = self.IDF[0x111]
-        fn.seek(entry.val_ofs)
-        fn.write(struct.pack(">I", self.img_ofs))
+        if entry.blk_ofs is None:
+            fn.seek(entry.val_ofs)
+        else:
+            fn.seek(entry.blk_ofs)
+        fn.write(struct.pack(">{0}I".format(len(strip_ofs)), *strip_ofs))
         fn.seek(ofs)
+        self.strip_ofs = strip_ofs
 
     # -----------------------------------------------------------------
     def add_tag(self, tag, value, tpe=None, cnt=None):
@@ -403,6 +575,8 @@ class Image(object):
     def _init_links(self):
         "required file-offsets needed to complete TIFF"
         self.img_ofs = None
+        self.strip_ofs = None
+        self.strip_md5 = None
         self.IDF_ofs = None
         self.next_link_ofs = None
 
@@ -453,32 +627,95 @@ class TIFF(object):
     """container object for all the images in a tiff file
     """
 
-    def __init__(self):
+    def __init__(self, dedup=None):
+        """usage: TIFF(dedup=None)
+        dedup - write identical strips only once, i.e. the strip offsets
+                of later images point to the first copy, None - if more
+                than one image
+        """
         self.images = []
+        self.dedup = dedup
 
     def add_image(self, img):
         self.images.append(img)
 
-    def write(self, fname):
-        print ".. write tiff file: {0}".format(fname)
+    def write(self, fname, manifest=False):
+        """write tiff file, optionally with a sidecar manifest of the
+        strip and IDF hashes (see lmanifest)
+        """
+        if _verbose:
+            print ".. write tiff file: {0}".format(fname)
 
         with open(fname, 'wb') as fn:
-            self._wr_hdr(fn)
+            self.write_fn(fn)
 
-            for img in self.images:
-                img.write_IDF(fn)
+        if manifest:
+            from lraw import lmanifest
+            lmanifest.write(fname, known=self._strip_digests())
 
-            # write all the image's data
-            for img in self.images:
-                img.write_data(fn)
 
-            # and back-patch IDF links
-            lnk_ofs = 4
-            for img in self.images:
-                fn.seek(lnk_ofs)
-                txt = struct.pack(">I", img.IDF_ofs)
-                fn.write(txt)
-                lnk_ofs = img.next_link_ofs
+    def _strip_digests(self):
+        "md5 of written strips from memory, dictionary offset -> hex digest"
+
+        known = {}
+        for img in self.images:
+            if img.strip_ofs is None:
+                continue
+            if img.strip_md5 is not None:
+                known.update(zip(img.strip_ofs, img.strip_md5))
+                continue
+            strips = [img.data] if img.strips is None else img.strips
+            for ofs, txt in zip(img.strip_ofs, strips):
+                known[ofs] = hashlib.md5(txt).hexdigest()
+        return known
+
+
+    def write_fn(self, fn):
+        """write the tiff container to an open, seekable file object
+
+        usage: write_fn(fn)
+        fn - file or file-like object (e.g. StringIO), positioned at 0
+        """
+        self._wr_hdr(fn)
+
+        for img in self.images:
+            img.write_IDF(fn)
+
+        # write all the image's data, shared strips only once
+        dedup = self.dedup
+        if dedup is None:
+            dedup = len(self.images) > 1
+        blocks = {} if dedup else None
+
+        for img in self.images:
+            img.write_data(fn, blocks)
+
+        if dedup:
+            self._dedup_report(blocks)
+
+        # and back-patch IDF links
+        lnk_ofs = 4
+        for img in self.images:
+            fn.seek(lnk_ofs)
+            txt = struct.pack(">I", img.IDF_ofs)
+            fn.write(txt)
+            lnk_ofs = img.next_link_ofs
+
+
+    def _dedup_report(self, blocks):
+        "set self.dedup_stats, with no. of strips and bytes written/shared"
+
+        nstrips = sum(len(img.strip_ofs) for img in self.images)
+        nbytes = sum(sum(len(txt) for txt in
+            ([img.data] if img.strips is None else img.strips))
+            for img in self.images)
+        nwr = sum(k[1] for k in blocks.keys())
+
+        self.dedup_stats = {'strips' : nstrips, 'written' : len(blocks),
+            'bytes' : nbytes, 'saved' : nbytes - nwr}
+        if _verbose and len(blocks) < nstrips:
+            print ".. dedup: {0} of {1} strips shared, {2} bytes saved".format(
+                nstrips - len(blocks), nstrips, nbytes - nwr)
 
 
     # ---------------------------------------------------------
@@ -487,3 +724,295 @@ class TIFF(object):
         txt = struct.pack(">HHI", 0x4D4D, 0x02A, ofs)
         fn.write(txt)
 
+
+
+
+class TIFF_Stream(TIFF):
+    """append-style tiff writer, each image's IDF and data is written
+    as soon as the image is added and the previous IDF link back-patched,
+    so memory use does not grow with the no. of images in the file
+
+    usage:
+      with TIFF_Stream(fname) as tif:
+          for img in frames:
+              tif.add_image(img)
+
+    note: the image data is released once written. dedup is off by
+    default, with dedup=True the digest of every unique strip written is
+    kept to share identical strips, i.e. memory grows with the no. of
+    distinct strips - meant for e.g. calibration stacks of few frames
+    """
+
+    def __init__(self, fname, dedup=False):
+        TIFF.__init__(self, dedup)
+
+        if _verbose:
+            print ".. stream tiff file: {0}".format(fname)
+
+        self.blocks = {} if dedup else None
+
+        self.fname = fname
+        self.nimg = 0
+        self.fn = open(fname, 'wb')
+        self._wr_hdr(self.fn)
+        self.lnk_ofs = 4
+
+
+    def add_image(self, img):
+        if self.fn is None:
+            raise TiffException("stream {0} closed".format(self.fname))
+
+        fn = self.fn
+        img.write_IDF(fn)
+        img.write_data(fn, self.blocks)
+
+        # link previous IDF (or header) to this one
+        fn.seek(self.lnk_ofs)
+        fn.write(struct.pack(">I", img.IDF_ofs))
+        fn.seek(0, 2)
+
+        self.lnk_ofs = img.next_link_ofs
+        self.nimg += 1
+        img.data = None
+        img.strips = None
+
+
+    def write(self, fname):
+        raise TiffException("images of a stream are written by add_image")
+
+
+    def close(self):
+        if self.fn is not None:
+            self.fn.close()
+            self.fn = None
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tpe, value, tb):
+        self.close()
+
+
+
+# ---------------------------------------------------------------------
+# read support, i.e. the IDF layout of an existing file
+
+# no. of bytes and struct format for all TIFF 6 tag types
+type_desc = {
+    1 : (1, 'B'),   2 : (1, 'B'),   3 : (2, 'H'),   4 : (4, 'I'),
+    5 : (8, 'II'),  6 : (1, 'b'),   7 : (1, 'B'),   8 : (2, 'h'),
+    9 : (4, 'i'),  10 : (8, 'ii'), 11 : (4, 'f'),  12 : (8, 'd'),
+    13 : (4, 'I')}
+
+
+class IDF_entry(object):
+    """IDF entry as found in an existing file
+
+    ofs     - file offset of the 12 byte entry
+    val_ofs - file offset of the value, i.e. ofs+8 if inline
+    txt     - value bytes, in file byte order
+    """
+
+    def __init__(self, bo, ofs, buf):
+        tag, tpe, cnt = struct.unpack(bo + "HHI", buf[:8])
+
+        self.bo = bo
+        self.ofs = ofs
+        self.tag = tag
+        self.tpe = tpe
+        self.cnt = cnt
+
+        nby = type_desc.get(tpe, (1, 'B'))[0]
+        self.nbytes = nby*cnt
+        self.inline = self.nbytes <= 4
+        if self.inline:
+            self.val_ofs = ofs + 8
+            self.txt = buf[8:8+self.nbytes]
+        else:
+            self.val_ofs = struct.unpack(bo + "I", buf[8:12])[0]
+            self.txt = None
+
+
+    def values(self):
+        "unpacked values as tuple, rationals as flat (num, den) pairs"
+
+        if self.tpe not in type_desc:
+            raise TiffException("tag 0x{0:04X}: unknown type {1}".format(
+                self.tag, self.tpe))
+
+        fmt = type_desc[self.tpe][1]
+        fmt = self.bo + self.cnt*fmt
+        return struct.unpack(fmt, self.txt)
+
+
+
+class IDF_dir(object):
+    """IDF as found in an existing file
+
+    IDF_ofs       - file offset of the IDF
+    link_ofs      - file offset of the pointer to this IDF
+    next_link_ofs - file offset of the pointer to the next IDF
+    entries       - dictionary tag -> IDF_entry
+    sub           - list with IDF_dir of the SubIFDs (0x014A)
+    """
+
+    def __init__(self, IDF_ofs, link_ofs):
+        self.IDF_ofs = IDF_ofs
+        self.link_ofs = link_ofs
+        self.next_link_ofs = None
+        self.entries = {}
+        self.sub = []
+
+
+    def value(self, tag, default=None):
+        "first value of tag, or default if not present"
+        if tag not in self.entries:
+            return default
+        return self.entries[tag].values()[0]
+
+
+    def strips(self):
+        "list of (offset, nbytes) of the strips or tiles of this IDF"
+
+        if 0x0144 in self.entries:
+            ofs, cnt = 0x0144, 0x0145
+        elif 0x0111 in self.entries:
+            ofs, cnt = 0x0111, 0x0117
+        else:
+            return []
+
+        if cnt not in self.entries:
+            raise TiffException("tag 0x{0:04X} without 0x{1:04X}".format(
+                ofs, cnt))
+        return zip(self.entries[ofs].values(), self.entries[cnt].values())
+
+
+    def tiles(self):
+        """strip/tile index, list of (x, y, w, h, offset, nbytes), with
+        strips handled as tiles of full image width
+        """
+
+        w = self.value(0x0100)
+        h = self.value(0x0101)
+        blks = self.strips()
+        if 0x0142 in self.entries:
+            tw = self.value(0x0142)
+            th = self.value(0x0143)
+        else:
+            tw = w
+            th = self.value(0x0116, h)
+
+        nx = (w + tw - 1)/tw
+        idx = []
+        for jj, (ofs, n) in enumerate(blks):
+            x = (jj % nx)*tw
+            y = (jj / nx)*th
+            idx.append((x, y, tw, th, ofs, n))
+        return idx
+
+
+
+class TIFF_Reader(object):
+    """parse IDF chain (and SubIFDs) of an existing tiff/dng file, only
+    the IDFs and their values are read, not the image data
+
+    usage: rd = TIFF_Reader(fn)
+    fn - file object, opened binary
+    rd.bo   - struct byte order prefix, '<' or '>'
+    rd.dirs - list of IDF_dir in the main chain
+    """
+
+    max_entries = 4096
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.seen = set()
+
+        fn.seek(0, 2)
+        self.size = fn.tell()
+
+        fn.seek(0)
+        txt = fn.read(8)
+        if len(txt) < 8:
+            raise TiffException("file too short for tiff header")
+
+        if txt[:2] == 'II':
+            self.bo = '<'
+        elif txt[:2] == 'MM':
+            self.bo = '>'
+        else:
+            raise TiffException("not a tiff file, bad byte order mark")
+
+        magic, ofs = struct.unpack(self.bo + "HI", txt[2:])
+        if magic != 0x2A:
+            raise TiffException("not a tiff file, magic={0}".format(magic))
+
+        self.dirs = []
+        link_ofs = 4
+        while ofs != 0:
+            d = self._read_dir(ofs, link_ofs)
+            self.dirs.append(d)
+            link_ofs = d.next_link_ofs
+            ofs = self._read_u32(link_ofs)
+
+
+    def all_dirs(self):
+        "list of all IDF_dir, SubIFDs following their parent"
+
+        def walk(dirs):
+            for d in dirs:
+                yield d
+                for s in walk(d.sub):
+                    yield s
+        return list(walk(self.dirs))
+
+
+    def read(self, ofs, n):
+        """read n bytes at ofs, the range is checked against the file
+        size first, so bogus counts/offsets raise TiffException
+        """
+        if ofs < 0 or n < 0 or ofs > self.size or n > self.size - ofs:
+            raise TiffException("read of {0} bytes @ 0x{1:08X} beyond end "
+                "of file".format(n, ofs))
+        self.fn.seek(ofs)
+        txt = self.fn.read(n)
+        if len(txt) != n:
+            raise TiffException("short read @ 0x{0:08X}".format(ofs))
+        return txt
+
+
+    # ---------------------------------------------------------
+    def _read_u32(self, ofs):
+        return struct.unpack(self.bo + "I", self.read(ofs, 4))[0]
+
+
+    def _read_dir(self, ofs, link_ofs):
+        if ofs in self.seen:
+            raise TiffException("IDF loop @ 0x{0:08X}".format(ofs))
+        self.seen.add(ofs)
+
+        bo = self.bo
+        n = struct.unpack(bo + "H", self.read(ofs, 2))[0]
+        if n > self.max_entries:
+            raise TiffException("IDF @ 0x{0:08X}: {1} entries".format(ofs, n))
+
+        d = IDF_dir(ofs, link_ofs)
+        buf = self.read(ofs + 2, 12*n + 4)
+        for jj in range(n):
+            e = IDF_entry(bo, ofs + 2 + 12*jj, buf[12*jj:12*jj+12])
+            d.entries[e.tag] = e
+        d.next_link_ofs = ofs + 2 + 12*n
+
+        # out-of-line values
+        for e in d.entries.values():
+            if e.txt is None:
+                e.txt = self.read(e.val_ofs, e.nbytes)
+
+        # SubIFDs
+        if 0x014A in d.entries:
+            e = d.entries[0x014A]
+            for jj, sub_ofs in enumerate(e.values()):
+                d.sub.append(self._read_dir(sub_ofs, e.val_ofs + 4*jj))
+
+        return d